@@ -1,48 +1,77 @@
 import cv2
+import numpy as np
 import torch
 import os
 from pathlib import Path
-import pickle
 from torch import nn
 import shutil
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import Dict
+from jit_cache import script_cached
+
+# Старі версії torch мають інше значення align_corners за замовчуванням
+ALIGN_CORNERS = int(torch.__version__[2]) > 2
+
+def max_pool(x, nms_radius: int):
+    # Функція для виконання max pooling. Квадратне вікно розкладаємо на
+    # рядок і стовпчик: результат той самий, а порівнянь 2k замість k*k
+    k = nms_radius*2+1
+    x = torch.nn.functional.max_pool2d(
+        x, kernel_size=(1, k), stride=1, padding=(0, nms_radius))
+    return torch.nn.functional.max_pool2d(
+        x, kernel_size=(k, 1), stride=1, padding=(nms_radius, 0))
 
 def simple_nms(scores, nms_radius: int):
   
     # Перевіряємо, що радіус NMS не від'ємний
     assert(nms_radius >= 0)
 
-    # Функція для виконання max pooling
-    def max_pool(x):
-        return torch.nn.functional.max_pool2d(
-            x, kernel_size=nms_radius*2+1, stride=1, padding=nms_radius)
-
     zeros = torch.zeros_like(scores)
-    max_mask = scores == max_pool(scores)
+    max_mask = scores == max_pool(scores, nms_radius)
 
     for _ in range(2):
-        supp_mask = max_pool(max_mask.float()) > 0
+        # Маску пропускаємо через max pooling як uint8 - у 4 рази менше даних
+        supp_mask = max_pool(max_mask.to(torch.uint8), nms_radius) > 0
         supp_scores = torch.where(supp_mask, zeros, scores)
-        new_max_mask = supp_scores == max_pool(supp_scores)
+        new_max_mask = supp_scores == max_pool(supp_scores, nms_radius)
         max_mask = max_mask | (new_max_mask & (~supp_mask))
     return torch.where(max_mask, scores, zeros)
 
-def remove_borders(keypoints, scores, border: int, height: int, width: int):
-    # Маска для видалення ключових точок біля меж зображення
-    mask_h = (keypoints[:, 0] >= border) & (keypoints[:, 0] < (height - border))
-    mask_w = (keypoints[:, 1] >= border) & (keypoints[:, 1] < (width - border))
-    mask = mask_h & mask_w
-    return keypoints[mask], scores[mask]
-
-
-def top_k_keypoints(keypoints, scores, k: int):
-    # Якщо кількість ключових точок менша за k, повертаємо всі точки
-    if k >= len(keypoints):
-        return keypoints, scores
-    # Вибираємо k ключових точок з найвищими оцінками
-    scores, indices = torch.topk(scores, k, dim=0)
-    return keypoints[indices], scores
-
-def sample_descriptors(keypoints, descriptors, s: int = 8):
+def extract_keypoints(scores, threshold: float, border: int, k: int):
+    # Обнуляємо оцінки біля меж зображення, щоб вони не пройшли поріг
+    b, height, width = scores.shape
+    scores[:, :border] = 0
+    scores[:, height - border:] = 0
+    scores[:, :, :border] = 0
+    scores[:, :, width - border:] = 0
+
+    # Вибираємо k+1 найкращих точок одним проходом по всьому пакету,
+    # (k+1)-ша показує, чи було кандидатів більше ніж k
+    values, indices = torch.topk(scores.reshape(b, -1), k + 1, dim=1)
+    dense = values[:, k] > threshold
+    values, indices = values[:, :k], indices[:, :k]
+    mask = values > threshold
+
+    # Якщо кандидатів не більше k, повертаємо їх у порядку рядків зображення
+    order = torch.where(mask, indices, height * width).argsort(dim=1)
+    order = torch.where(dense[:, None], torch.arange(k, device=scores.device)[None], order)
+    values, indices = values.gather(1, order), indices.gather(1, order)
+    mask = mask.gather(1, order)
+
+    # Переводимо індекси у координати (x, y), невалідні точки обнуляємо
+    keypoints = torch.stack([indices % width, indices // width], dim=-1).float()
+    keypoints = torch.where(mask[..., None], keypoints, torch.zeros_like(keypoints))
+    values = torch.where(mask, values, torch.zeros_like(values))
+    return keypoints, values, mask
+
+# L2-нормалізація вздовж каналів за один прохід через rsqrt
+def l2_normalize(x):
+    return x * x.pow(2).sum(1, keepdim=True).clamp_min(1e-12).rsqrt()
+
+def sample_descriptors(keypoints, descriptors, s: int = 8,
+                       align_corners: bool = ALIGN_CORNERS):
     # Нормалізуємо координати ключових точок
     b, c, h, w = descriptors.shape
     keypoints = keypoints - s / 2 + 0.5
@@ -51,11 +80,10 @@ def sample_descriptors(keypoints, descriptors, s: int = 8):
     keypoints = keypoints*2 - 1  # нормалізуємо до (-1, 1)
 
     # Вибираємо дескриптори, які відповідають ключовим точкам
-    args = {'align_corners': True} if int(torch.__version__[2]) > 2 else {}
     descriptors = torch.nn.functional.grid_sample(
-    descriptors, keypoints.view(b, 1, -1, 2), mode='bilinear', **args)
-    descriptors = torch.nn.functional.normalize(
-    descriptors.reshape(b, c, -1), p=2, dim=1)
+    descriptors, keypoints.view(b, 1, -1, 2), mode='bilinear',
+    align_corners=align_corners)
+    descriptors = l2_normalize(descriptors.reshape(b, c, -1))
     return descriptors
 
 class SuperPoint(nn.Module):
@@ -106,7 +134,7 @@ class SuperPoint(nn.Module):
             raise ValueError('\"max_keypoints\" must be positive or \"-1\"')
         
     # Метод для визначення ключових точок та дескрипторів
-    def forward(self, data):
+    def forward(self, data: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
         # Обчислюємо ключові точки
         x = self.relu(self.conv1a(data['image']))
         x = self.relu(self.conv1b(x))
@@ -123,50 +151,46 @@ class SuperPoint(nn.Module):
         # Оцінюємо ключові точки
         cPa = self.relu(self.convPa(x))
         scores = self.convPb(cPa)
-        scores = torch.nn.functional.softmax(scores, 1)[:, :-1]
-        b, _, h, w = scores.shape
-        scores = scores.permute(0, 2, 3, 1).reshape(b, h, w, 8, 8)
-        scores = scores.permute(0, 1, 3, 2, 4).reshape(b, h*8, w*8)
+        # Softmax без каналу "dustbin": віднімаємо максимум, експонуємо лише
+        # перші 64 канали і ділимо на суму разом з експонентою dustbin
+        scores = scores - scores.amax(1, keepdim=True)
+        dustbin = scores[:, -1:].exp()
+        scores = scores[:, :-1].exp()
+        scores = scores / (scores.sum(1, keepdim=True) + dustbin)
+        scores = torch.nn.functional.pixel_shuffle(scores, 8).squeeze(1)
         scores = simple_nms(scores, 4)  # nms_radius
 
-        # Визначаємо ключові точки з оцінкою більше порогового значення
-        keypoints = [
-            torch.nonzero(s > 0.005)  # keypoint_threshold
-            for s in scores]
-        scores = [s[tuple(k.t())] for s, k in zip(scores, keypoints)]
-
-        # Видаляємо ключові точки біля меж зображення
-        keypoints, scores = list(zip(*[
-            remove_borders(k, s, 4, h*8, w*8)
-            for k, s in zip(keypoints, scores)]))
-
-        # Вибираємо кращі ключові точки
-        keypoints, scores = list(zip(*[
-            top_k_keypoints(k, s, 1024) 
-            for k, s in zip(keypoints, scores)]))
-        keypoints = [torch.flip(k, [1]).float() for k in keypoints]
+        # Визначаємо ключові точки з оцінкою більше порогового значення,
+        # без точок біля меж зображення, та вибираємо 1024 кращих
+        keypoints, kpt_scores, mask = extract_keypoints(
+            scores, 0.005, 4, 1024)  # keypoint_threshold, remove_borders
 
         # Обчислюємо дескриптори
         cDa = self.relu(self.convDa(x))
         descriptors = self.convDb(cDa)
-        descriptors = torch.nn.functional.normalize(descriptors, p=2, dim=1)
+        descriptors = l2_normalize(descriptors)
 
-        # Вибираємо дескриптори, які відповідають ключовим точкам
-        descriptors = [sample_descriptors(k[None], d[None], 8)[0]
-                       for k, d in zip(keypoints, descriptors)]
+        # Вибираємо дескриптори, які відповідають ключовим точкам,
+        # одним викликом для всього пакета (B, 1024, 2)
+        descriptors = sample_descriptors(keypoints, descriptors, 8)
 
         return {
             'keypoints': keypoints,
-            'scores': scores,
+            'scores': kpt_scores,
             'descriptors': descriptors,
+            'mask': mask,
         }
 
-def img2superpoint(input_dir, output_path):
-    # Вимикаємо автоматичне обчислення градієнтів
-    torch.set_grad_enabled(False)
-    
+def load_image(path):
+    # Завантажуємо зображення у відтінках сірого та змінюємо розмір
+    image = cv2.imread(str(path), cv2.IMREAD_GRAYSCALE)
+    return cv2.resize(image, (640, 480))
+
+def img2superpoint(input_dir, output_path, batch_size=16, prefetch_batches=2):
     # Завантажуємо модель SuperPoint
     superpoint = SuperPoint({}).eval().to('cpu')
+    superpoint = script_cached(
+        superpoint, 'superpoint', Path(__file__).parent / 'weights/superpoint_v1.pth')
 
     # Завантажуємо всі зображення з вказаної директорії
     input_path = Path(input_dir)
@@ -186,23 +210,37 @@ def img2superpoint(input_dir, output_path):
             elif os.path.isdir(item_path):
                 shutil.rmtree(item_path)  # Видаляє каталог з усім вмістом
 
-    # Обробляємо кожне зображення директорії
-    for i, image_name in enumerate(all_images_name):
-        stem_image_name = Path(image_name).stem
-
-        # Завантажуємо зображення та перетворюємо його у масив
-        image = cv2.imread(str(input_path / image_name), cv2.IMREAD_GRAYSCALE)
-        image = cv2.resize(image, (640, 480))
-
-        # Видаляємо шум за допомогою медіанного фільтра
-        image = image.astype('float32')
-        
-        # Відрегулювати яскравість та контрастність
-        tensor_image = torch.from_numpy(image / 255.).float()[None, None].to('cpu')
-
-        # Передаємо зображення у модель SuperPoint
-        pred = superpoint({'image': tensor_image})
-        
-        # Зберігаємо результат у файл .pickle
-        with open(f'{output_path}/{stem_image_name}.pickle', 'wb') as file:
-            pickle.dump(pred, file)
\ No newline at end of file
+    # Декодуємо зображення у фонових потоках, поки модель обробляє
+    # попередній пакет (cv2 звільняє GIL під час читання та зміни розміру).
+    # Наперед читаємо не більше prefetch_batches пакетів, щоб у пам'яті
+    # не накопичувались усі декодовані зображення
+    with ThreadPoolExecutor() as executor:
+        paths = (input_path / image_name for image_name in all_images_name)
+        pending = deque(executor.submit(load_image, path)
+                        for path in islice(paths, prefetch_batches * batch_size))
+
+        # Обробляємо зображення пакетами по batch_size штук
+        for start in range(0, len(all_images_name), batch_size):
+            batch_names = all_images_name[start:start + batch_size]
+
+            # Збираємо пакет зображень у масив (B, 480, 640) і ставимо
+            # у чергу декодування зображення наступного пакета
+            images = [pending.popleft().result() for _ in batch_names]
+            pending.extend(executor.submit(load_image, path)
+                           for path in islice(paths, len(batch_names)))
+            images = np.stack(images).astype('float32')
+
+            # Формуємо тензор (B, 1, 480, 640) зі значеннями в діапазоні [0, 1]
+            batch = torch.from_numpy(images).unsqueeze(1) / 255.
+
+            # Передаємо весь пакет у модель SuperPoint за один прохід
+            with torch.inference_mode():
+                pred = superpoint({'image': batch})
+
+            # Зберігаємо результат кожного зображення у окремий файл .pt,
+            # який потім можна відобразити у пам'ять без десеріалізації
+            for i, image_name in enumerate(batch_names):
+                stem_image_name = Path(image_name).stem
+                # clone() потрібен, щоб у файл не потрапило сховище всього пакета
+                pred_i = {k: v[i:i + 1].clone() for k, v in pred.items()}
+                torch.save(pred_i, f'{output_path}/{stem_image_name}.pt')
@@ -0,0 +1,30 @@
+import hashlib
+import inspect
+import torch
+from pathlib import Path
+
+# Каталог для збереження скомпільованих TorchScript моделей
+CACHE_DIR = Path(__file__).parent / 'weights/jit'
+
+def script_cached(module, name, weights_path):
+    # Ключ кешу залежить від ваг, коду моделі та версії torch
+    digest = hashlib.sha256()
+    digest.update(Path(weights_path).read_bytes())
+    digest.update(Path(inspect.getsourcefile(type(module))).read_bytes())
+    digest.update(torch.__version__.encode())
+    path = CACHE_DIR / '{}_{}.pt'.format(name, digest.hexdigest()[:16])
+
+    # Якщо модель вже скомпільована, завантажуємо її з диска
+    if path.exists():
+        scripted = torch.jit.load(str(path))
+    else:
+        # Компілюємо модель та заморожуємо ваги
+        scripted = torch.jit.freeze(torch.jit.script(module.eval()))
+
+        # Зберігаємо результат для наступних запусків
+        CACHE_DIR.mkdir(exist_ok=True, parents=True)
+        torch.jit.save(scripted, str(path))
+
+    # Оптимізовані для інференсу графи не серіалізуються, тому цей крок
+    # виконуємо вже після завантаження
+    return torch.jit.optimize_for_inference(scripted)
@@ -1,12 +1,15 @@
 import numpy as np
 import pickle
 import os
+import warnings
 import torch
 from pathlib import Path
 from torch import nn
-from copy import deepcopy
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+from functools import lru_cache
+from typing import List, Optional
 import pandas as pd
-import shutil
+from jit_cache import script_cached
 
 def MLP(channels: list, do_bn=True):
     # Створюємо послідовну модель для MLP
@@ -21,6 +24,19 @@ def MLP(channels: list, do_bn=True):
             layers.append(nn.ReLU())
     return nn.Sequential(*layers)
 
+def fuse_conv_bn(model):
+    # Згортаємо пари Conv1d -> BatchNorm1d у одну згортку з новими вагами,
+    # BatchNorm замінюємо на nn.Identity, щоб індекси шарів не змінились
+    for module in model.modules():
+        if not isinstance(module, nn.Sequential):
+            continue
+        for i in range(len(module) - 1):
+            conv, bn = module[i], module[i + 1]
+            if isinstance(conv, nn.Conv1d) and isinstance(bn, nn.BatchNorm1d):
+                module[i] = fuse_conv_bn_eval(conv, bn)
+                module[i + 1] = nn.Identity()
+    return model
+
 class KeypointEncoder(nn.Module):
     # Клас для кодування ключових точок
 
@@ -44,12 +60,27 @@ def normalize_keypoints(kpts, image_shape):
     scaling = size.max(1, keepdim=True).values * 0.7
     return (kpts - center[:, None, :]) / scaling[:, None, :]
 
-def attention(query, key, value):
-    # Обчислюємо ймовірність та вагу для кожної пари ключ-значення
+def key_bias(mask, dtype: torch.dtype) -> Optional[torch.Tensor]:
+    # Адитивне зміщення (b, 1, 1, m) для оцінок уваги: -inf для доповнених
+    # ключових точок. Без доповнення зміщення не потрібне. Якщо в парі
+    # немає жодної валідної точки, маску не застосовуємо, щоб softmax не
+    # повернув NaN
+    if bool(mask.all()):
+        return None
+    valid = mask | ~mask.any(1, keepdim=True)
+    bias = torch.zeros(mask.shape, dtype=dtype, device=mask.device)
+    return bias.masked_fill(~valid, float('-inf'))[:, None, None, :]
+
+def attention(query, key, value, key_bias: Optional[torch.Tensor]):
+    # Обчислюємо ймовірність та вагу для кожної пари ключ-значення,
+    # доповнені ключові точки виключаємо зміщенням -inf. Входи (b, d, h, n)
+    # переставляємо так, щоб обидва добутки були пакетними matmul по головах
     dim = query.shape[1]
-    scores = torch.einsum('bdhn,bdhm->bhnm', query, key) / dim**.5
+    scores = torch.matmul(query.permute(0, 2, 3, 1), key.permute(0, 2, 1, 3)) / dim**.5
+    if key_bias is not None:
+        scores = scores + key_bias
     prob = torch.nn.functional.softmax(scores, dim=-1)
-    return torch.einsum('bhnm,bdhm->bdhn', prob, value), prob
+    return torch.matmul(prob, value.permute(0, 2, 3, 1)).permute(0, 3, 1, 2)
 
 class MultiHeadedAttention(nn.Module):
     # Клас для обчислення уваги для кількох голов
@@ -61,15 +92,17 @@ class MultiHeadedAttention(nn.Module):
         self.dim = d_model // num_heads
         self.num_heads = num_heads
         self.merge = nn.Conv1d(d_model, d_model, kernel_size=1)
-        self.proj = nn.ModuleList([deepcopy(self.merge) for _ in range(3)])
+        self.proj = nn.ModuleList([
+            nn.Conv1d(d_model, d_model, kernel_size=1) for _ in range(3)])
 
     # Метод для передачі даних через модель
-    def forward(self, query, key, value):
+    def forward(self, query, key, value, key_bias: Optional[torch.Tensor]):
         batch_dim = query.size(0)
-        query, key, value = [l(x).view(batch_dim, self.dim, self.num_heads, -1)
-                             for l, x in zip(self.proj, (query, key, value))]
-        x, _ = attention(query, key, value)
-        return self.merge(x.contiguous().view(batch_dim, self.dim*self.num_heads, -1))
+        query = self.proj[0](query).view(batch_dim, self.dim, self.num_heads, -1)
+        key = self.proj[1](key).view(batch_dim, self.dim, self.num_heads, -1)
+        value = self.proj[2](value).view(batch_dim, self.dim, self.num_heads, -1)
+        x = attention(query, key, value, key_bias)
+        return self.merge(x.reshape(batch_dim, self.dim*self.num_heads, -1))
 
 class AttentionalPropagation(nn.Module):
     # Клас для обчислення якості співпадіння ключових точок
@@ -82,15 +115,15 @@ class AttentionalPropagation(nn.Module):
         nn.init.constant_(self.mlp[-1].bias, 0.0)
 
     # Метод для передачі даних через модель
-    def forward(self, x, source):
-        message = self.attn(x, source, source)
+    def forward(self, x, source, source_bias: Optional[torch.Tensor]):
+        message = self.attn(x, source, source, source_bias)
         return self.mlp(torch.cat([x, message], dim=1))
 
 class AttentionalGNN(nn.Module):
     # Клас для обчислення зваженої суми дескрипторів
 
     # Конструктор класу
-    def __init__(self, feature_dim: int, layer_names: list):
+    def __init__(self, feature_dim: int, layer_names: List[str]):
         super().__init__()
         self.layers = nn.ModuleList([
             AttentionalPropagation(feature_dim, 4)
@@ -98,31 +131,72 @@ class AttentionalGNN(nn.Module):
         self.names = layer_names
 
     # Метод для передачі даних через модель
-    def forward(self, desc0, desc1):
-        for layer, name in zip(self.layers, self.names):
-            if name == 'cross':
+    def forward(self, desc0, desc1, mask0, mask1):
+        # Зміщення для масок обчислюємо один раз для всіх шарів
+        bias0, bias1 = key_bias(mask0, desc0.dtype), key_bias(mask1, desc1.dtype)
+        for i, layer in enumerate(self.layers):
+            if self.names[i] == 'cross':
                 src0, src1 = desc1, desc0
+                srcbias0, srcbias1 = bias1, bias0
             else:  # if name == 'self':
                 src0, src1 = desc0, desc1
-            delta0, delta1 = layer(desc0, src0), layer(desc1, src1)
+                srcbias0, srcbias1 = bias0, bias1
+            delta0 = layer(desc0, src0, srcbias0)
+            delta1 = layer(desc1, src1, srcbias1)
             desc0, desc1 = (desc0 + delta0), (desc1 + delta1)
         return desc0, desc1
 
+def sinkhorn_step(Z, u, v, log_mu, log_nu):
+    # Одна ітерація Синкхорна у логарифмічному просторі
+    u = log_mu - torch.logsumexp(Z + v.unsqueeze(1), dim=2)
+    v = log_nu - torch.logsumexp(Z + u.unsqueeze(2), dim=1)
+    return u, v
+
+# Компілюємо лише одну ітерацію Синкхорна: цикл залишається у Python,
+# тому кількість ітерацій не розгортається і не збільшує час компіляції.
+# Розміри входу залежать від кількості точок, тому ядро загальне по формі.
+# Без Inductor або компілятора C++ ітерації виконуються без компіляції,
+# інші помилки не перехоплюються
+try:
+    from torch._dynamo.exc import BackendCompilerFailed
+    from torch._inductor.exc import CppCompileError
+    COMPILE_ERRORS = (BackendCompilerFailed, CppCompileError)
+    _sinkhorn_step = torch.compile(sinkhorn_step, dynamic=True)
+except (ImportError, RuntimeError):
+    COMPILE_ERRORS = ()
+    _sinkhorn_step = sinkhorn_step
+
 def log_sinkhorn_iterations(Z, log_mu, log_nu, iters: int):
     # Обчислюємо стабільну оптимальну транспортну функцію
+    global _sinkhorn_step
     u, v = torch.zeros_like(log_mu), torch.zeros_like(log_nu)
     for _ in range(iters):
-        u = log_mu - torch.logsumexp(Z + v.unsqueeze(1), dim=2)
-        v = log_nu - torch.logsumexp(Z + u.unsqueeze(2), dim=1)
+        try:
+            u, v = _sinkhorn_step(Z, u, v, log_mu, log_nu)
+        except COMPILE_ERRORS as error:
+            # Компіляція не вдалася: попереджаємо і далі працюємо без неї
+            warnings.warn(f'torch.compile failed for the Sinkhorn step, '
+                          f'running it eagerly: {error}')
+            _sinkhorn_step = sinkhorn_step
+            u, v = sinkhorn_step(Z, u, v, log_mu, log_nu)
     return Z + u.unsqueeze(2) + v.unsqueeze(1)
 
-def log_optimal_transport(scores, alpha, iters: int):
+def log_marginal(mask, norm, bin_count):
+    # Логарифм маси точок і бінного значення. Доповнені точки отримують
+    # нульову масу (-inf у логарифмі), без доповнення маску не застосовуємо
+    b, n = mask.shape
+    if bool(mask.all()):
+        log_mass = norm[:, None].expand(b, n)
+    else:
+        log_mass = torch.where(mask, norm[:, None], norm.new_tensor(float('-inf')))
+    return torch.cat([log_mass, (bin_count.log() + norm)[:, None]], 1)
+
+def log_optimal_transport(scores, alpha, iters: int, mask0, mask1):
     # Обчислюємо оптимальну транспортну функцію
 
-    # Розмірність матриці
+    # Розмірність матриці та кількість валідних точок у кожній парі
     b, m, n = scores.shape
-    one = scores.new_tensor(1)
-    ms, ns = (m*one).to(scores), (n*one).to(scores)
+    ms, ns = mask0.sum(1).to(scores), mask1.sum(1).to(scores)
 
     bins0 = alpha.expand(b, m, 1)
     bins1 = alpha.expand(b, 1, n)
@@ -134,13 +208,12 @@ def log_optimal_transport(scores, alpha, iters: int):
     
     # Логарифмуємо оцінки та бінні значення
     norm = - (ms + ns).log()
-    log_mu = torch.cat([norm.expand(m), ns.log()[None] + norm])
-    log_nu = torch.cat([norm.expand(n), ms.log()[None] + norm])
-    log_mu, log_nu = log_mu[None].expand(b, -1), log_nu[None].expand(b, -1)
+    log_mu = log_marginal(mask0, norm, ns)
+    log_nu = log_marginal(mask1, norm, ms)
 
     # Обчислюємо оптимальну транспортну функцію
     Z = log_sinkhorn_iterations(couplings, log_mu, log_nu, iters)
-    Z = Z - norm 
+    Z = Z - norm[:, None, None]
     return Z
 
 def arange_like(x, dim: int):
@@ -157,6 +230,8 @@ class SuperGlue(nn.Module):
         'GNN_layers': ['self', 'cross'] * 9,
         'sinkhorn_iterations': 100,
         'match_threshold': 0.2,
+        'bf16': False,
+        'image_shape': None,
     }
 
     # Конструктор класу
@@ -182,14 +257,54 @@ class SuperGlue(nn.Module):
         path = path / 'weights/superglue_{}.pth'.format(self.config['weights'])
         self.load_state_dict(torch.load(str(path), weights_only = True))
 
+        # Модель використовується лише для інференсу, тому одразу
+        # згортаємо BatchNorm у ваги попередніх згорток
+        fuse_conv_bn(self.eval())
+
+        # Графову мережу можна виконувати у bfloat16: на процесорах з
+        # AVX512-BF16/AMX це вдвічі менше даних і швидші матричні множення.
+        # Проекція та Синкхорн залишаються у float32
+        if self.config['bf16']:
+            self.gnn.to(torch.bfloat16)
+
+        # Для фіксованого розміру зображень (висота, ширина) константи
+        # нормалізації ключових точок обчислюємо один раз, а зображення
+        # image0/image1 у forward можна не передавати
+        if self.config['image_shape'] is not None:
+            height, width = self.config['image_shape']
+            size = torch.tensor([float(width), float(height)])
+            self.register_buffer('norm_center', size / 2, persistent=False)
+            self.register_buffer('norm_scaling', size.max() * 0.7, persistent=False)
+
+    def normalize(self, kpts, image):
+        # Нормалізуємо координати ключових точок. Без зображення
+        # використовуємо фіксований розмір з конфігурації
+        if image is None:
+            if self.config['image_shape'] is None:
+                raise ValueError('image0/image1 are required when image_shape is not set')
+            return (kpts - self.norm_center) / self.norm_scaling
+        if tuple(image.shape[-2:]) == self.config['image_shape']:
+            return (kpts - self.norm_center) / self.norm_scaling
+        return normalize_keypoints(kpts, image.shape)
+
+    def encode(self, kpts, scores, desc, image=None):
+        # Додаємо до дескрипторів закодовані ключові точки. Для запиту
+        # результат обчислюється один раз і передається у forward як encoded0
+        return desc + self.kenc(self.normalize(kpts, image), scores)
+
     def forward(self, data):
         # Передача даних через модель
         desc0, desc1 = data['descriptors0'], data['descriptors1']
         kpts0, kpts1 = data['keypoints0'], data['keypoints1']
 
+        # Маски валідних ключових точок (без масок всі точки валідні)
+        mask0 = data.get('mask0', kpts0.new_ones(kpts0.shape[:-1], dtype=torch.bool))
+        mask1 = data.get('mask1', kpts1.new_ones(kpts1.shape[:-1], dtype=torch.bool))
+
         # Перевірка наявності ключових точок
         if kpts0.shape[1] == 0 or kpts1.shape[1] == 0:
-            shape0, shape1 = kpts0.shape[:-1], kpts1.shape[:-1]
+            b = max(kpts0.shape[0], kpts1.shape[0])
+            shape0, shape1 = (b, kpts0.shape[1]), (b, kpts1.shape[1])
             return {
                 'matches0': kpts0.new_full(shape0, -1, dtype=torch.int),
                 'matches1': kpts1.new_full(shape1, -1, dtype=torch.int),
@@ -197,28 +312,38 @@ class SuperGlue(nn.Module):
                 'matching_scores1': kpts1.new_zeros(shape1),
             }
 
-        # Нормалізуємо координати ключових точок
-        kpts0 = normalize_keypoints(kpts0, data['image0'].shape)
-        kpts1 = normalize_keypoints(kpts1, data['image1'].shape)
-
-        # Кодуємо ключові точки
-        desc0 = desc0 + self.kenc(kpts0, data['scores0'])
-        desc1 = desc1 + self.kenc(kpts1, data['scores1'])
+        # Кодуємо ключові точки. Запит, спільний для всіх пар, можна закодувати
+        # заздалегідь (encoded0) і передати з розміром пакета 1: тоді він
+        # розширюється на весь пакет без копіювання
+        if 'encoded0' in data:
+            desc0 = data['encoded0']
+        else:
+            desc0 = self.encode(kpts0, data['scores0'], desc0, data.get('image0'))
+        desc1 = self.encode(kpts1, data['scores1'], desc1, data.get('image1'))
+        b = max(desc0.shape[0], desc1.shape[0])
+        desc0, desc1 = desc0.expand(b, -1, -1), desc1.expand(b, -1, -1)
+        mask0, mask1 = mask0.expand(b, -1), mask1.expand(b, -1)
 
         # Передача даних через графічну нейронну мережу
-        desc0, desc1 = self.gnn(desc0, desc1)
+        if self.config['bf16']:
+            desc0, desc1 = self.gnn(
+                desc0.bfloat16(), desc1.bfloat16(), mask0, mask1)
+            desc0, desc1 = desc0.float(), desc1.float()
+        else:
+            desc0, desc1 = self.gnn(desc0, desc1, mask0, mask1)
 
         # Проектуємо дескриптори
         mdesc0, mdesc1 = self.final_proj(desc0), self.final_proj(desc1)
 
         # Обчислюємо оцінки співпадіння
-        scores = torch.einsum('bdn,bdm->bnm', mdesc0, mdesc1)
+        scores = torch.bmm(mdesc0.transpose(1, 2), mdesc1)
         scores = scores / self.config['descriptor_dim']**.5
 
         # Обчислюємо оптимальну транспортну функцію
         scores = log_optimal_transport(
             scores, self.bin_score,
-            iters=self.config['sinkhorn_iterations'])
+            iters=self.config['sinkhorn_iterations'],
+            mask0=mask0, mask1=mask1)
 
         # Обчислюємо співпадіння
         max0, max1 = scores[:, :-1, :-1].max(2), scores[:, :-1, :-1].max(1)
@@ -244,23 +369,66 @@ class SuperGlue(nn.Module):
 def ranking_score(matches, match_confidence):
     return np.sum(np.multiply(matches, match_confidence)).astype(np.float32)
 
-# Функція для завантаження файлу .pickle
-def load_pickle(path):
+# Розширення файлів з ключовими точками: .pt (torch.save) та старий .pickle
+SUPERPOINTS_EXTENSIONS = ('.pt', '.pickle')
+
+# Функція для завантаження файлу бази з ключовими точками. Кожен файл бази
+# читається для кожного запиту, тому результати кешуються. Час зміни, розмір
+# та inode входять у ключ, щоб перезаписаний файл не брався з кешу
+def load_superpoints(path):
+    stat = os.stat(path)
+    return _load_superpoints_cached(
+        path, stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+@lru_cache(maxsize=512)
+def _load_superpoints_cached(path, mtime, size, inode):
+    # Файли .pt бази відображаються у пам'ять без копіювання тензорів
+    return read_superpoints(path, mmap=True)
+
+# Функція для читання файлу з ключовими точками без кешу. Так читаються
+# кадри-запити: img2superpoint видаляє і перезаписує їх для кожного фото,
+# тому їх не можна тримати відображеними у пам'ять (на Windows такий файл
+# неможливо видалити)
+def read_superpoints(path, mmap=False):
+    if path.endswith('.pt'):
+        return torch.load(path, mmap=mmap, weights_only=True)
+
     with open(path, 'rb') as file:
         loaded = pickle.load(file)
+    # Файли старого формату зберігають списки тензорів без маски
+    if 'mask' not in loaded:
+        loaded = pad_superpoints(loaded)
     return loaded
 
-# Функція для обробки файлу .pickle
-def process_superpoints(file, input_dir, output_dir):
+# Функція для перетворення старого формату у доповнені тензори з маскою
+def pad_superpoints(superpoints, max_keypoints=1024):
+    kpts = superpoints['keypoints'][0]
+    n = kpts.shape[0]
+    pad = max_keypoints - n
+    return {
+        'keypoints': torch.nn.functional.pad(kpts, (0, 0, 0, pad))[None],
+        'scores': torch.nn.functional.pad(superpoints['scores'][0], (0, pad))[None],
+        'descriptors': torch.nn.functional.pad(superpoints['descriptors'][0], (0, pad))[None],
+        'mask': (torch.arange(max_keypoints) < n)[None],
+    }
+
+# Функція для обрізання доповнених тензорів до перших n ключових точок
+def trim_superpoints(superpoints, n):
+    return {
+        'keypoints': superpoints['keypoints'][:, :n],
+        'scores': superpoints['scores'][:, :n],
+        'descriptors': superpoints['descriptors'][:, :, :n],
+        'mask': superpoints['mask'][:, :n],
+    }
+
+# Функція для обробки файлу з ключовими точками
+def process_superpoints(superglue, file, input_dir, output_dir, batch_size=1):
     # Отримуємо ім'я файлу з його шляху
     main_file = os.path.basename(file)
-    # Створюємо новий шлях для файлу в каталозі ./data
-    new_file_path = os.path.join(input_dir, main_file)
-    # Копіюємо файл
-    shutil.copy(os.path.join(input_dir, file), new_file_path)
 
-    # Створюємо словник для збереження оцінок
+    # Створюємо словник для збереження оцінок і список результатів пар
     score_dict = {}
+    results = []
 
     # ініціалізуємо шляхи
     input_dir = Path(input_dir)
@@ -268,65 +436,84 @@ def process_superpoints(file, input_dir, output_dir):
     output_dir.mkdir(exist_ok=True, parents=True)
     all_file_name = os.listdir(input_dir)
 
-    # Знаходимо всі файли .pickle в input_dir
-    pairs = [(main_file, file_name) for file_name in all_file_name if file_name.endswith('.pickle')]
-
-    config = {
-        'superglue': {
-            'weights': 'indoor',
-            'sinkhorn_iterations': 20,
-            'match_threshold': 0.2,
-        }
-    }
-
-    # Завантажуємо модель SuperGlue
-    superglue = SuperGlue(config).eval().to('cpu')
-
-    # Обробляємо кожну пару файлів
-    for i, pair in enumerate(pairs):
-        name0, name1 = pair[:2]
-        stem0, stem1 = Path(name0).stem, Path(name1).stem
-        matches_path = output_dir / '{}_{}_matches.npz'.format(stem0, stem1)
-        do_match = True
-
-        # Завантажуємо файли .pickle
-        superpoints_0 = load_pickle(str(input_dir / name0))
-        superpoints_1 = load_pickle(str(input_dir / name1))
-
-        # Перевіряємо наявність ключових точок
-        superpoints_0 = {k + '0': v for k, v in superpoints_0.items()}
+    # Знаходимо всі файли з ключовими точками в input_dir, крім файлу з
+    # таким самим ім'ям, як запит: пару запиту з самим собою додаємо окремо
+    main_stem = Path(main_file).stem
+    pairs = [(main_file, file_name) for file_name in all_file_name
+             if file_name.endswith(SUPERPOINTS_EXTENSIONS)
+             and Path(file_name).stem != main_stem]
+
+    # Завантажуємо ключові точки запиту та обрізаємо доповнення
+    query = read_superpoints(str(input_dir / file))
+    n0 = int(query['mask'][0].sum())
+    superpoints_0 = trim_superpoints(query, n0)
+    kpts0 = superpoints_0['keypoints'][0, :n0].cpu().numpy()
+    superpoints_0 = {k + '0': v for k, v in superpoints_0.items()}
+
+    # Кодуємо ключові точки запиту один раз для всіх пар з базою
+    if n0 > 0:
+        superpoints_0['encoded0'] = superglue.encode(
+            superpoints_0['keypoints0'], superpoints_0['scores0'],
+            superpoints_0['descriptors0'])
+
+    # Сортуємо файли бази за кількістю ключових точок, щоб у кожному
+    # пакеті були файли схожого розміру і доповнення було мінімальним.
+    # Запит порівнюється і сам з собою для нормалізації оцінок
+    database = [((main_file, main_file), query)]
+    database += [(pair, load_superpoints(str(input_dir / pair[1]))) for pair in pairs]
+    database.sort(key=lambda item: int(item[1]['mask'][0].sum()))
+
+    # Обробляємо пари пакетами: запит порівнюється з batch_size файлами бази
+    # за один прохід моделі SuperGlue. На процесорі пакети повільніші за
+    # окремі пари (доповнення до найбільшої кількості точок та обмеження
+    # пропускною здатністю пам'яті), тому за замовчуванням пари по одній
+    for start in range(0, len(database), batch_size):
+        batch_pairs = [pair for pair, _ in database[start:start + batch_size]]
+        batch = [sp for _, sp in database[start:start + batch_size]]
+
+        # Об'єднуємо файли бази у тензори (B, K, ...), де K - найбільша
+        # кількість валідних точок у пакеті. Запит передаємо з
+        # розміром пакета 1, SuperGlue кодує його один раз на весь пакет
+        superpoints_1 = {k: torch.cat([sp[k] for sp in batch]) for k in batch[0]}
+        superpoints_1 = trim_superpoints(
+            superpoints_1, int(superpoints_1['mask'].sum(1).max()))
         superpoints_1 = {k + '1': v for k, v in superpoints_1.items()}
 
-        # Перевіряємо наявність ключових точок
-        if superpoints_0 is None or superpoints_1 is None:
-            exit(1)
-        
-        # Передача даних через модель SuperGlue        
-        dummy_data = {'image0': np.zeros((1, 1, 1000, 1000)),
-                        'image1': np.zeros((1, 1, 1000, 1000))}
-        data = {**dummy_data, **superpoints_0, **superpoints_1}
-        for k in data:
-            if isinstance(data[k], (list, tuple)):
-                data[k] = torch.stack(data[k])
+        # Передача даних через модель SuperGlue. Розмір зображень задано
+        # у конфігурації, тому самі зображення не передаємо
+        data = {**superpoints_0, **superpoints_1}
         pred = superglue(data)
-        pred = {k: v[0].cpu().numpy() for k, v in pred.items()}
-
-        kpts0, kpts1 = superpoints_0['keypoints0'][0].cpu().numpy(), superpoints_1['keypoints1'][0].cpu().numpy()
-        matches, conf = pred['matches0'], pred['matching_scores0']
-
-        # Зберігаємо результат у файл
-        out_matches = {'keypoints0': kpts0, 'keypoints1': kpts1,
-                        'matches': matches, 'match_confidence': conf}
-
-        # Обчислюємо оцінку співпадіння
-        score_dict[stem1] = ranking_score(matches, conf)
-
-        # Перевіряємо чи ім'я файлу співпадає
-        if name0 == name1:
-            full_score = score_dict[stem1]
-
-        # Зберігаємо результат у файл .npz
-        np.savez(str(matches_path), **out_matches)
+        pred = {k: v.cpu().numpy() for k, v in pred.items()}
+
+        for j, (name0, name1) in enumerate(batch_pairs):
+            stem1 = Path(name1).stem
+
+            # Залишаємо лише валідні ключові точки
+            n1 = int(superpoints_1['mask1'][j].sum())
+            kpts1 = superpoints_1['keypoints1'][j, :n1].cpu().numpy()
+            matches, conf = pred['matches0'][j, :n0], pred['matching_scores0'][j, :n0]
+            results.append((stem1, kpts1, matches, conf))
+
+            # Обчислюємо оцінку співпадіння
+            score_dict[stem1] = ranking_score(matches, conf)
+
+            # Перевіряємо чи ім'я файлу співпадає
+            if name0 == name1:
+                full_score = score_dict[stem1]
+
+    # Зберігаємо результати всіх пар запиту в один файл .npz: матриці (N, K)
+    # співпадінь (int16, бо точок не більше 1024) та впевненості (float16),
+    # а ключові точки бази доповнюємо нулями до найбільшої кількості
+    names, kpts1_list, matches_list, conf_list = zip(*results)
+    num_keypoints1 = np.array([len(kpts1) for kpts1 in kpts1_list], dtype=np.int16)
+    keypoints1 = np.zeros((len(results), num_keypoints1.max(), 2), dtype=np.float32)
+    for i, kpts1 in enumerate(kpts1_list):
+        keypoints1[i, :len(kpts1)] = kpts1
+    np.savez(str(output_dir / '{}_matches.npz'.format(main_stem)),
+             names=np.array(names), keypoints0=kpts0,
+             keypoints1=keypoints1, num_keypoints1=num_keypoints1,
+             matches=np.stack(matches_list).astype(np.int16),
+             match_confidence=np.stack(conf_list).astype(np.float16))
 
     # Сортуємо оцінки
     ranked_images = {k: v for k, v in sorted(score_dict.items(), reverse=True, key=lambda x: x[1])}
@@ -338,28 +525,44 @@ def process_superpoints(file, input_dir, output_dir):
     df.rename(columns={'index': 'image'}, inplace=True)
     df.to_csv(str(output_dir / 'ranking_score.csv'), index=True)
 
-    # Після завершення роботи видаляємо копію файлу
-    if os.path.exists(new_file_path):
-        os.remove(new_file_path)
-
 # Функція для обчислення оцінки співпадіння
-def superpoints2rank (input_dir, output_base_dir):
+def superpoints2rank (input_dir, output_base_dir, bf16=False):
     # Встановлюємо параметри для обчислення
     os.environ["KMP_DUPLICATE_LIB_OK"] = "TRUE"
 
     # Вимикаємо автоматичне обчислення градієнтів
     torch.set_grad_enabled(False)
 
-    # Знаходимо всі файли .pickle в input_dir
-    pickle_files = [f for f in os.listdir(input_dir) if f.endswith('.pickle')]
+    # Знаходимо всі файли з ключовими точками в input_dir
+    superpoints_files = [f for f in os.listdir(input_dir) if f.endswith(SUPERPOINTS_EXTENSIONS)]
     
     input_dir = os.path.dirname(input_dir.rstrip('/'))
 
-    # Запускаємо process_superpoints для кожного файлу
-    for pickle_file in pickle_files:
-        file_path = f'frame_superpoints/{pickle_file}'
-        output_dir, _ = os.path.splitext(os.path.join(output_base_dir, pickle_file))
-        process_superpoints(file_path, input_dir, output_dir)
+    # Увага: SuperGlue не читає вкладений словник 'superglue', тому модель
+    # працює з параметрами за замовчуванням (100 ітерацій Синкхорна).
+    # Словник залишено без змін, щоб не змінювати результати ранжування
+    config = {
+        'superglue': {
+            'weights': 'indoor',
+            'sinkhorn_iterations': 20,
+            'match_threshold': 0.2,
+        },
+    }
 
+    # Параметри, які SuperGlue справді використовує, передаємо окремо
+    options = {'bf16': bf16, 'image_shape': (1000, 1000)}
 
+    # Завантажуємо модель SuperGlue один раз для всіх файлів
+    # та компілюємо графову мережу
+    superglue = SuperGlue({**config, **options}).eval().to('cpu')
+    weights_path = Path(__file__).parent / 'weights/superglue_{}.pth'.format(
+        superglue.config['weights'])
+    gnn_name = 'superglue_gnn_bf16' if bf16 else 'superglue_gnn'
+    superglue.gnn = script_cached(superglue.gnn, gnn_name, weights_path)
 
+    # Запускаємо process_superpoints для кожного файлу
+    for superpoints_file in superpoints_files:
+        file_path = f'frame_superpoints/{superpoints_file}'
+        output_dir, _ = os.path.splitext(os.path.join(output_base_dir, superpoints_file))
+        with torch.inference_mode():
+            process_superpoints(superglue, file_path, input_dir, output_dir)